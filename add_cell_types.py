@@ -3,9 +3,20 @@
 Add cell type column to regions_genes CSV files by merging with cell type assignment CSVs.
 """
 
+import argparse
+import os
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
 
+from csv_cache import read_csv_cached
+
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
 # Sample name mapping: regions_genes sample name -> cell_type file name
 SAMPLE_MAPPING = {
     'fem3_5x_E7_A_left': '5x_E7_A_left',
@@ -23,15 +34,68 @@ CELL_TYPING_DIR = Path('/Users/yaarakarasik/data_for_publication/cell_typing_all
 REGIONS_GENES_DIR = Path('/Users/yaarakarasik/assign_regions/data/outputs/output_correct')
 OUTPUT_DIR = Path('/Users/yaarakarasik/data_for_publication/explore-ExSeq-brain-AD')
 
+# Route through the streaming Polars pipeline when FAST=1 and polars is installed
+USE_POLARS = pl is not None and os.environ.get('FAST') == '1'
+
+
+def _clean_key(column):
+    """Polars expression stripping whitespace and quotes from a key column."""
+    return pl.col(column).str.strip_chars().str.strip_chars('"')
+
+
+def add_cell_types_polars(regions_genes_file, cell_type_file, output_file, output_format='csv'):
+    """Join cell types onto a regions_genes CSV with a lazy, streaming Polars plan.
+
+    Every column is read as text and passed through unchanged, so values are
+    written back exactly as they appear in the input.
+    """
+    print(f"  Streaming {regions_genes_file} with Polars")
+    
+    cell_types = (
+        pl.scan_csv(cell_type_file, infer_schema=False)
+        .select(_clean_key('cell_index'), _clean_key('cell_type'))
+        .drop_nulls()
+        .unique(subset='cell_index', keep='last')
+    )
+    plan = (
+        pl.scan_csv(regions_genes_file, infer_schema=False)
+        .with_columns(_clean_key('cell').alias('cell_clean'))
+        .join(cell_types, left_on='cell_clean', right_on='cell_index', how='left', maintain_order='left')
+        .drop('cell_clean')
+        .with_columns(pl.col('cell_type').fill_null('unassigned'))
+    )
+    
+    print(f"  Saving to: {output_file}")
+    if output_format == 'parquet':
+        plan.sink_parquet(output_file, compression='zstd')
+        output = pl.scan_parquet(output_file)
+    else:
+        plan.sink_csv(output_file)
+        output = pl.scan_csv(output_file, infer_schema=False)
+    
+    # Count statistics by re-reading only cell_type from the written output;
+    # for CSV output this is a second full parse, the cost of streaming the join
+    counts = output.select(
+        pl.len().alias('rows'),
+        (pl.col('cell_type') != 'unassigned').sum().alias('assigned'),
+    ).collect()
+    total_count, assigned_count = counts.row(0)
+    print(f"  Statistics:")
+    print(f"    Assigned cells: {assigned_count:,} rows")
+    print(f"    Unassigned cells: {total_count - assigned_count:,} rows")
+    print(f"  ✓ Successfully saved {total_count:,} rows")
+    
+    return True
+
 
-def add_cell_types(sample_name, cell_type_name):
-    """Add cell_type column to a regions_genes CSV file."""
+def add_cell_types(sample_name, cell_type_name, output_format='csv'):
+    """Add cell_type column to a regions_genes CSV file, saved as CSV or Parquet."""
     print(f"\nProcessing {sample_name}...")
     
     # Construct file paths
     regions_genes_file = REGIONS_GENES_DIR / sample_name / f"{sample_name}_regions_genes.csv"
     cell_type_file = CELL_TYPING_DIR / f"cell_type_{cell_type_name}.csv"
-    output_file = OUTPUT_DIR / f"{sample_name}_regions_genes_with_cell_types.csv"
+    output_file = OUTPUT_DIR / f"{sample_name}_regions_genes_with_cell_types.{output_format}"
     
     # Check if files exist
     if not regions_genes_file.exists():
@@ -42,34 +106,48 @@ def add_cell_types(sample_name, cell_type_name):
         print(f"  ERROR: Cell type file not found: {cell_type_file}")
         return False
     
+    if USE_POLARS:
+        return add_cell_types_polars(regions_genes_file, cell_type_file, output_file, output_format)
+    
     # Load data
     print(f"  Loading regions_genes from: {regions_genes_file}")
-    regions_df = pd.read_csv(regions_genes_file)
+    regions_df = read_csv_cached(
+        regions_genes_file,
+        dtype_backend='pyarrow',
+        dtype={'cell': 'string[pyarrow]'},
+    )
     print(f"    Loaded {len(regions_df):,} rows")
     
     print(f"  Loading cell types from: {cell_type_file}")
-    cell_type_df = pd.read_csv(cell_type_file)
+    cell_type_df = pd.read_csv(
+        cell_type_file,
+        engine='pyarrow',
+        dtype_backend='pyarrow',
+        dtype={'cell_index': 'string[pyarrow]', 'cell_type': 'string[pyarrow]'},
+    )
     print(f"    Loaded {len(cell_type_df):,} cell type assignments")
     
-    # Create a mapping dictionary from cell_index to cell_type
+    # Build a lookup table from cell_index to cell_type
+    # Rows with an empty cell_index or cell_type carry no assignment; dropping
+    # them makes those cells 'unassigned' on every pandas version and in the
+    # Polars path, instead of whatever string astype(str) gives a missing value
+    cell_type_df = cell_type_df.dropna(subset=['cell_index', 'cell_type'])
     # Handle potential string formatting differences (quotes, whitespace)
-    cell_type_map = {}
-    for _, row in cell_type_df.iterrows():
-        cell_index = str(row['cell_index']).strip().strip('"')
-        cell_type = str(row['cell_type']).strip().strip('"')
-        cell_type_map[cell_index] = cell_type
-    
-    print(f"    Created mapping for {len(cell_type_map):,} cells")
-    
-    # Map cell_type to regions_df
-    # Clean cell column values (remove quotes if present)
-    regions_df['cell_clean'] = regions_df['cell'].astype(str).str.strip().str.strip('"')
-    
-    # Add cell_type column using map, defaulting to 'unassigned' for unmatched cells
-    regions_df['cell_type'] = regions_df['cell_clean'].map(cell_type_map).fillna('unassigned')
-    
-    # Drop the temporary clean column
-    regions_df = regions_df.drop(columns=['cell_clean'])
+    cell_types = pd.DataFrame({
+        'cell_index': cell_type_df['cell_index'].astype(str).str.strip().str.strip('"'),
+        'cell_type': cell_type_df['cell_type'].astype(str).str.strip().str.strip('"'),
+    }).drop_duplicates(subset='cell_index', keep='last')
+    
+    print(f"    Created mapping for {len(cell_types):,} cells")
+    
+    # Join cell_type onto regions_df
+    # Clean cell values (remove quotes if present) on the fly as the join key,
+    # defaulting to 'unassigned' for unmatched cells
+    cell_clean = regions_df['cell'].astype(str).str.strip().str.strip('"').to_numpy()
+    regions_df = regions_df.merge(
+        cell_types, left_on=cell_clean, right_on='cell_index', how='left'
+    ).drop(columns=['cell_index'])
+    regions_df['cell_type'] = regions_df['cell_type'].fillna('unassigned')
     
     # Count statistics
     assigned_count = (regions_df['cell_type'] != 'unassigned').sum()
@@ -80,7 +158,10 @@ def add_cell_types(sample_name, cell_type_name):
     
     # Save output
     print(f"  Saving to: {output_file}")
-    regions_df.to_csv(output_file, index=False)
+    if output_format == 'parquet':
+        regions_df.to_parquet(output_file, compression='zstd', index=False)
+    else:
+        regions_df.to_csv(output_file, index=False, chunksize=1_000_000)
     print(f"  ✓ Successfully saved {len(regions_df):,} rows")
     
     return True
@@ -88,16 +169,23 @@ def add_cell_types(sample_name, cell_type_name):
 
 def main():
     """Process all sample pairs."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                        help="output file format (default: csv)")
+    args = parser.parse_args()
+    
     print("=" * 60)
     print("Adding Cell Types to Regions Genes CSVs")
     print("=" * 60)
     
-    success_count = 0
     total_count = len(SAMPLE_MAPPING)
     
-    for sample_name, cell_type_name in SAMPLE_MAPPING.items():
-        if add_cell_types(sample_name, cell_type_name):
-            success_count += 1
+    # Samples are independent, so process them in parallel worker processes
+    max_workers = min(total_count, os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(add_cell_types, SAMPLE_MAPPING.keys(), SAMPLE_MAPPING.values(),
+                               repeat(args.format))
+        success_count = sum(results)
     
     print("\n" + "=" * 60)
     print(f"Processing complete: {success_count}/{total_count} samples processed successfully")
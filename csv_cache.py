@@ -0,0 +1,48 @@
+"""
+Parquet cache for large CSV inputs.
+
+The first read of a CSV writes a sibling .parquet file; later reads use it
+for as long as it is at least as new as the CSV and holds the requested
+columns.
+"""
+
+import pandas as pd
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+from pathlib import Path
+
+
+def _cache_is_fresh(csv_path, parquet_path, usecols):
+    """Check that the Parquet copy is up to date and has every needed column."""
+    if not parquet_path.exists():
+        return False
+    if parquet_path.stat().st_mtime < csv_path.stat().st_mtime:
+        return False
+    if usecols is None:
+        # A full read needs every CSV column, not just those a projected read cached
+        # Read the header with the same Arrow parser that filled the cache
+        usecols = pv.open_csv(csv_path).schema.names
+    return set(usecols) <= set(pq.read_schema(parquet_path).names)
+
+
+def read_csv_cached(csv_path, usecols=None, dtype_backend=None, **read_csv_kwargs):
+    """Load a CSV, preferring an up-to-date Parquet copy next to it."""
+    csv_path = Path(csv_path)
+    parquet_path = csv_path.with_suffix('.parquet')
+    backend_kwargs = {'dtype_backend': dtype_backend} if dtype_backend else {}
+
+    if _cache_is_fresh(csv_path, parquet_path, usecols):
+        print(f"  Using cached {parquet_path}")
+        df = pd.read_parquet(parquet_path, columns=usecols, **backend_kwargs)
+        dtype = read_csv_kwargs.get('dtype')
+        return df.astype(dtype) if dtype else df
+
+    df = pd.read_csv(csv_path, engine='pyarrow', usecols=usecols,
+                     **backend_kwargs, **read_csv_kwargs)
+
+    try:
+        df.to_parquet(parquet_path, compression='zstd', index=False)
+    except OSError as e:
+        print(f"  Warning: could not write Parquet cache {parquet_path}: {e}")
+
+    return df
@@ -8,6 +8,11 @@ import json
 import os
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 def generate_manifest():
     """Generate manifest.json from CSV files in data/csvs/"""
     csv_dir = Path("data/csvs")
@@ -17,8 +22,10 @@ def generate_manifest():
         print(f"Warning: {csv_dir} does not exist")
         return
     
-    # Find all CSV files
-    csv_files = sorted(csv_dir.glob("*.csv"))
+    # Find all CSV files (scandir reuses directory entry data, no extra stat calls)
+    with os.scandir(csv_dir) as entries:
+        csv_files = sorted(entry.name for entry in entries
+                           if entry.name.endswith(".csv") and entry.is_file())
     
     if not csv_files:
         print(f"Warning: No CSV files found in {csv_dir}")
@@ -29,11 +36,11 @@ def generate_manifest():
         manifest = []
         for csv_file in csv_files:
             # Get relative path from index.html (which is at repo root)
-            relative_path = str(csv_file)
+            relative_path = str(csv_dir / csv_file)
             
             # Generate display name from filename
             # Remove common suffixes and format nicely
-            name = csv_file.stem
+            name = csv_file[:-len(".csv")]
             # Remove common suffixes like "_regions_genes_with_cell_types"
             if "_regions_genes_with_cell_types" in name:
                 name = name.replace("_regions_genes_with_cell_types", "")
@@ -46,8 +53,13 @@ def generate_manifest():
             })
     
     # Write manifest
-    with open(manifest_path, 'w') as f:
-        json.dump(manifest, f, indent=2)
+    # orjson is faster but optional, so plain Python 3 is enough to run this
+    if orjson is not None:
+        with open(manifest_path, 'wb') as f:
+            f.write(orjson.dumps(manifest, option=orjson.OPT_INDENT_2))
+    else:
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
     
     print(f"Generated manifest with {len(manifest)} CSV files")
     print(f"Manifest saved to: {manifest_path}")
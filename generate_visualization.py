@@ -11,13 +11,72 @@ import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
 import plotly.express as px
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
 from pathlib import Path
+from typing import NamedTuple
+
+from csv_cache import read_csv_cached
+
+# Columns used by the visualizations and the dtypes they are loaded as
+COLUMN_DTYPES = {
+    'gene': 'category',
+    'region': 'category',
+    'fov': 'category',
+    'cell_id': 'int64',
+    'x_coordinate': 'float32',
+    'y_coordinate': 'float32',
+    'z_coordinate': 'float32',
+    'region_area': 'float64',
+    'region_proportion': 'float64',
+}
+
+# Shared write_html settings; figures are already validated when built
+WRITE_HTML_OPTIONS = dict(
+    include_plotlyjs='cdn',
+    include_mathjax=False,
+    validate=False,
+    auto_play=False,
+    config={'responsive': True},
+)
+
+# Hover label for each column that can appear in a point's tooltip
+HOVER_LABELS = {
+    'gene': 'Gene',
+    'region': 'Region',
+    'cell_id': 'Cell',
+    'fov': 'FOV',
+    'z_coordinate': 'Z',
+}
+
+
+def _stratified_sample(df, n, random_state=0):
+    """Randomly sample at most n rows, keeping one per (region, gene) pair where possible."""
+    if len(df) == 0:
+        return df
+    
+    rng = np.random.default_rng(random_state)
+    shuffled = df.iloc[rng.permutation(len(df))]
+    # dropna=False keeps rows with a missing region or gene as their own pairs
+    groups = shuffled.groupby(['region', 'gene'], observed=True, sort=False, dropna=False)
+    rank = groups.cumcount().to_numpy()
+    quota = np.maximum(1, groups['gene'].transform('size').to_numpy() * n // len(df))
+    keep = rank < quota
+    
+    # The one-row minimum can overshoot n; trim the highest within-pair ranks first
+    kept = np.flatnonzero(keep)
+    if len(kept) > n:
+        keep[:] = False
+        keep[kept[np.argsort(rank[kept], kind='stable')[:n]]] = True
+    
+    return shuffled[keep]
 
 
 def load_and_process_data(csv_path):
-    """Load the CSV data and create downsampled and full datasets."""
+    """Load the CSV data and create downsampled, plotting and full datasets."""
     print("Loading data from CSV...")
-    df = pd.read_csv(csv_path)
+    df = read_csv_cached(csv_path, usecols=list(COLUMN_DTYPES), dtype=COLUMN_DTYPES)
     
     print(f"Loaded {len(df)} rows")
     print(f"Columns: {df.columns.tolist()}")
@@ -27,13 +86,104 @@ def load_and_process_data(csv_path):
     unique_regions = sorted(df['region'].unique().tolist())
     unique_fovs = sorted(df['fov'].unique().tolist())
     
-    # Create downsampled dataset (every 10th point for overview)
+    # Create downsampled dataset (~1 in 10 points of every region/gene pair for overview)
     downsample_factor = 10
-    df_overview = df.iloc[::downsample_factor].copy()
+    # Round up so inputs smaller than the factor still keep at least one point
+    overview_size = max(1, -(-len(df) // downsample_factor))
+    df_overview = _stratified_sample(df, overview_size).sort_index()
+    
+    print(f"Downsampled to {len(df_overview)} points (~1 in {downsample_factor} per region/gene)")
+    
+    # Draw the plotting sample once; the random order lets each view take a prefix
+    df_plot = _stratified_sample(df_overview, min(10000, len(df_overview)))
     
-    print(f"Downsampled to {len(df_overview)} points (every {downsample_factor}th)")
+    return df, df_overview, df_plot, unique_genes, unique_regions, unique_fovs
+
+
+def _format_2f(array):
+    """Format a float Arrow array like '{:.2f}' using only Arrow kernels."""
+    array = pc.cast(array, pa.float64())
+    # Work in integer hundredths so the fraction is always two zero-padded digits
+    magnitude = pc.abs(pc.cast(pc.round(pc.multiply(array, 100)), pa.int64()))
+    whole = pc.divide(magnitude, 100)
+    fraction = pc.subtract(magnitude, pc.multiply(whole, 100))
+    return pc.binary_join_element_wise(
+        pc.if_else(pc.less(array, 0), '-', ''),
+        pc.cast(whole, pa.string()),
+        '.',
+        pc.utf8_lpad(pc.cast(fraction, pa.string()), width=2, padding='0'),
+        ''
+    )
+
+
+def _as_arrow_strings(values):
+    """Convert a column to an Arrow string array, formatting floats to 2 decimals."""
+    array = pa.Array.from_pandas(values)
+    if pa.types.is_dictionary(array.type):
+        array = array.dictionary_decode()
+    if pa.types.is_floating(array.type):
+        return _format_2f(array)
+    return pc.cast(array, pa.string())
+
+
+def _hover_text(df, columns):
+    """Build one "Label: value<br>..." hover string per row of df."""
+    parts = []
+    for column in columns:
+        prefix = HOVER_LABELS[column] + ': '
+        parts += [prefix if not parts else '<br>' + prefix, _as_arrow_strings(df[column])]
+    
+    # Concatenate all parts in a single Arrow kernel (last argument is the separator)
+    text = pc.binary_join_element_wise(*parts, '', null_handling='replace', null_replacement='nan')
+    return text.to_numpy(zero_copy_only=False)
+
+
+def _sort_by_region(df_sample, regions):
+    """Sort df_sample by region and map each region to its contiguous row slice."""
+    codes = df_sample['region'].cat.codes.to_numpy()
+    categories = df_sample['region'].cat.categories
+    order = np.argsort(codes, kind='stable')
+    # CSR-style offsets: rows of category k are indptr[k]:indptr[k + 1]
+    indptr = np.searchsorted(codes[order], np.arange(len(categories) + 1))
+    
+    region_slices = {}
+    for region in regions:
+        if region in categories:
+            k = categories.get_loc(region)
+            region_slices[region] = slice(indptr[k], indptr[k + 1])
     
-    return df, df_overview, unique_genes, unique_regions, unique_fovs
+    return df_sample.iloc[order], region_slices
+
+
+class PlotState(NamedTuple):
+    """Plotting sample and lookups shared by the 2D, 3D and dashboard views."""
+    df_sample: pd.DataFrame  # sorted by region
+    xs: np.ndarray
+    ys: np.ndarray
+    zs: np.ndarray
+    region_slices: dict
+    region_colors: dict
+
+
+def _prepare_plot_state(df_plot, regions):
+    """Sort the plotting sample by region once and precompute arrays and colors."""
+    df_sample, region_slices = _sort_by_region(df_plot, regions)
+    xs, ys, zs = (df_sample[column].to_numpy(dtype=np.float32)
+                  for column in ['x_coordinate', 'y_coordinate', 'z_coordinate'])
+    palette = px.colors.qualitative.Set3
+    region_colors = {region: palette[i % len(palette)] for i, region in enumerate(regions)}
+    return PlotState(df_sample, xs, ys, zs, region_slices, region_colors)
+
+
+def _region_rows(state, region, max_points):
+    """Row slice of a region, shortened so all regions total about max_points rows."""
+    rows = state.region_slices.get(region)
+    total = len(state.df_sample)
+    if rows is None or total <= max_points:
+        return rows
+    # Rows within a region are in random order, so a prefix is a random subsample
+    count = -(-(rows.stop - rows.start) * max_points // total)
+    return slice(rows.start, rows.start + count)
 
 
 def save_overview_data(df_overview, output_dir):
@@ -41,32 +191,61 @@ def save_overview_data(df_overview, output_dir):
     output_dir = Path(output_dir)
     output_dir.mkdir(exist_ok=True)
     
-    # Convert DataFrame to JSON
-    data_dict = df_overview.to_dict('records')
+    # Convert DataFrame to records of NumPy scalars; unlike to_dict('records'),
+    # this keeps float32 coordinates as float32 so orjson writes their short form
+    columns = df_overview.columns.tolist()
+    data_dict = [dict(zip(columns, row))
+                 for row in zip(*(df_overview[column].to_numpy() for column in columns))]
     
     output_file = output_dir / "overview.json"
     print(f"Saving overview data to {output_file}...")
     
-    with open(output_file, 'w') as f:
-        json.dump(data_dict, f)
+    with open(output_file, 'wb') as f:
+        f.write(orjson.dumps(data_dict, option=orjson.OPT_SERIALIZE_NUMPY))
     
     print(f"Saved {len(data_dict)} points to overview.json")
     
     return str(output_file)
 
 
+def _count_distinct(group_codes, values, n_groups):
+    """Count distinct values per group code with one lexsort over integer arrays."""
+    order = np.lexsort((values, group_codes))
+    groups_sorted = group_codes[order]
+    values_sorted = values[order]
+    # A row starts a new (group, value) run when either key changes
+    is_new = np.ones(len(order), dtype=bool)
+    is_new[1:] = (groups_sorted[1:] != groups_sorted[:-1]) | (values_sorted[1:] != values_sorted[:-1])
+    return np.bincount(groups_sorted[is_new], minlength=n_groups)
+
+
 def calculate_statistics(df, output_dir):
     """Calculate and save statistics per region."""
-    stats = {}
+    region_codes = df['region'].cat.codes.to_numpy()
+    has_region = region_codes >= 0
+    region_codes = region_codes[has_region]
+    n_regions = len(df['region'].cat.categories)
+    
+    total_points = np.bincount(region_codes, minlength=n_regions)
+    cell_counts = _count_distinct(region_codes, df['cell_id'].to_numpy()[has_region], n_regions)
+    # Missing genes have code -1; skip them like nunique skips NaN
+    gene_codes = df['gene'].cat.codes.to_numpy()[has_region]
+    has_gene = gene_codes >= 0
+    gene_counts = _count_distinct(region_codes[has_gene], gene_codes[has_gene], n_regions)
+    
+    # Area and proportion are constant per region; take each region's first row
+    observed, first_rows = np.unique(region_codes, return_index=True)
+    areas = df['region_area'].to_numpy()[has_region]
+    proportions = df['region_proportion'].to_numpy()[has_region]
     
-    for region in df['region'].unique():
-        region_df = df[df['region'] == region]
-        stats[region] = {
-            'cell_count': region_df['cell_id'].nunique(),
-            'unique_genes': region_df['gene'].nunique(),
-            'total_points': len(region_df),
-            'area': region_df['region_area'].iloc[0],
-            'proportion': region_df['region_proportion'].iloc[0]
+    stats = {}
+    for k, row in sorted(zip(observed, first_rows), key=lambda pair: pair[1]):
+        stats[df['region'].cat.categories[k]] = {
+            'cell_count': int(cell_counts[k]),
+            'unique_genes': int(gene_counts[k]),
+            'total_points': int(total_points[k]),
+            'area': float(areas[row]),
+            'proportion': float(proportions[row])
         }
     
     output_file = Path(output_dir) / "stats.json"
@@ -77,12 +256,12 @@ def calculate_statistics(df, output_dir):
     return stats
 
 
-def create_2d_visualization(df_overview, df_full, genes, regions, fovs):
+def create_2d_visualization(state, df_full, genes, regions, fovs):
     """Create a 2D scatter plot visualization with gene and region filters."""
     print("Creating 2D visualization...")
     
-    # Sample a subset for initial display (more points for better coverage)
-    df_sample = df_overview.sample(min(10000, len(df_overview)))
+    # Use the full shared sample for initial display (more points for better coverage)
+    df_sample = state.df_sample
     
     # Create figure
     fig = go.Figure()
@@ -91,14 +270,18 @@ def create_2d_visualization(df_overview, df_full, genes, regions, fovs):
     gene_colors = px.colors.qualitative.Dark24 + px.colors.qualitative.Light24
     unique_genes_shown = sorted(df_sample['gene'].unique())
     
+    # Partition the sample once instead of re-filtering it per gene and region
+    gene_groups = dict(list(df_sample.groupby('gene', observed=True, sort=False)))
+    region_gene_groups = dict(list(df_sample.groupby(['region', 'gene'], observed=True, sort=False)))
+    
     for i, gene in enumerate(unique_genes_shown):
-        gene_df = df_sample[df_sample['gene'] == gene]
-        if len(gene_df) == 0:
+        gene_df = gene_groups.get(gene)
+        if gene_df is None:
             continue
         
         fig.add_trace(go.Scattergl(
-            x=gene_df['x_coordinate'],
-            y=gene_df['y_coordinate'],
+            x=gene_df['x_coordinate'].to_numpy(dtype=np.float32),
+            y=gene_df['y_coordinate'].to_numpy(dtype=np.float32),
             mode='markers',
             marker=dict(
                 size=5,
@@ -106,12 +289,7 @@ def create_2d_visualization(df_overview, df_full, genes, regions, fovs):
                 opacity=0.6,
                 line=dict(width=0)
             ),
-            text=[f"Gene: {g}<br>Region: {r}<br>Cell: {c}<br>FOV: {f}<br>Z: {z:.2f}" 
-                  for g, r, c, f, z in zip(gene_df['gene'], 
-                                            gene_df['region'],
-                                            gene_df['cell_id'],
-                                            gene_df['fov'],
-                                            gene_df['z_coordinate'])],
+            text=_hover_text(gene_df, ['gene', 'region', 'cell_id', 'fov', 'z_coordinate']),
             hovertemplate='<b>%{text}</b><extra></extra>',
             name=gene,
             visible=True,
@@ -123,30 +301,23 @@ def create_2d_visualization(df_overview, df_full, genes, regions, fovs):
     buttons = [dict(
         label="All Regions",
         method="restyle",
-        args=[{"x": [gene_df['x_coordinate'].tolist() for gene in unique_genes_shown for gene_df in [df_sample[df_sample['gene'] == gene]] if len(df_sample[df_sample['gene'] == gene]) > 0], 
-              "y": [gene_df['y_coordinate'].tolist() for gene in unique_genes_shown for gene_df in [df_sample[df_sample['gene'] == gene]] if len(df_sample[df_sample['gene'] == gene]) > 0]}]
+        args=[{"x": [gene_groups[gene]['x_coordinate'].to_numpy(dtype=np.float32) for gene in unique_genes_shown if gene in gene_groups],
+              "y": [gene_groups[gene]['y_coordinate'].to_numpy(dtype=np.float32) for gene in unique_genes_shown if gene in gene_groups]}]
     )]
     
     # Add button for each region
     for region in regions:
-        region_df = df_sample[df_sample['region'] == region]
-        
         # Get data for each gene in this region
         x_data = []
         y_data = []
         text_data = []
         
         for gene in unique_genes_shown:
-            gene_region_df = region_df[region_df['gene'] == gene]
-            if len(gene_region_df) > 0:
-                x_data.append(gene_region_df['x_coordinate'].tolist())
-                y_data.append(gene_region_df['y_coordinate'].tolist())
-                text_data.append([f"Gene: {g}<br>Region: {r}<br>Cell: {c}<br>FOV: {f}<br>Z: {z:.2f}" 
-                                 for g, r, c, f, z in zip(gene_region_df['gene'], 
-                                                          gene_region_df['region'],
-                                                          gene_region_df['cell_id'], 
-                                                          gene_region_df['fov'],
-                                                          gene_region_df['z_coordinate'])])
+            gene_region_df = region_gene_groups.get((region, gene))
+            if gene_region_df is not None:
+                x_data.append(gene_region_df['x_coordinate'].to_numpy(dtype=np.float32))
+                y_data.append(gene_region_df['y_coordinate'].to_numpy(dtype=np.float32))
+                text_data.append(_hover_text(gene_region_df, ['gene', 'region', 'cell_id', 'fov', 'z_coordinate']))
             else:
                 x_data.append([])
                 y_data.append([])
@@ -233,38 +404,33 @@ def create_2d_visualization(df_overview, df_full, genes, regions, fovs):
     return fig
 
 
-def create_3d_visualization(df_overview, df_full, genes, regions, fovs):
+def create_3d_visualization(state, df_full, genes, regions, fovs):
     """Create a 3D scatter plot visualization with region colors."""
     print("Creating 3D visualization...")
     
     # Create figure
     fig = go.Figure()
     
-    # Sample subset for initial display
-    df_sample = df_overview.sample(min(8000, len(df_overview)))
+    # Shared sample; each region is capped so the view shows ~8000 points
+    df_sample, xs, ys, zs = state.df_sample, state.xs, state.ys, state.zs
     
     # Create traces for each region
-    region_colors = px.colors.qualitative.Set3
-    for i, region in enumerate(regions):
-        region_df = df_sample[df_sample['region'] == region]
-        if len(region_df) == 0:
+    for region in regions:
+        rows = _region_rows(state, region, 8000)
+        if rows is None or rows.start == rows.stop:
             continue
         
         fig.add_trace(go.Scatter3d(
-            x=region_df['x_coordinate'],
-            y=region_df['y_coordinate'],
-            z=region_df['z_coordinate'],
+            x=xs[rows],
+            y=ys[rows],
+            z=zs[rows],
             mode='markers',
             marker=dict(
                 size=1.5,
-                color=region_colors[i % len(region_colors)],
+                color=state.region_colors[region],
                 opacity=0.6
             ),
-            text=[f"Gene: {g}<br>Region: {r}<br>Cell: {c}<br>FOV: {f}" 
-                  for g, r, c, f in zip(region_df['gene'], 
-                                          region_df['region'],
-                                          region_df['cell_id'],
-                                          region_df['fov'])],
+            text=_hover_text(df_sample.iloc[rows], ['gene', 'region', 'cell_id', 'fov']),
             hovertemplate='<b>%{text}</b><extra></extra>',
             name=region,
             showlegend=True
@@ -305,7 +471,7 @@ def create_3d_visualization(df_overview, df_full, genes, regions, fovs):
     return fig
 
 
-def create_dashboard(df_overview, df_full, stats, genes, regions, fovs):
+def create_dashboard(state, df_full, stats, genes, regions, fovs):
     """Create a combined dashboard with 2D and 3D views."""
     print("Creating dashboard...")
     
@@ -321,31 +487,27 @@ def create_dashboard(df_overview, df_full, stats, genes, regions, fovs):
         horizontal_spacing=0.15
     )
     
-    # Sample data
-    df_sample = df_overview.sample(min(6000, len(df_overview)))
-    
-    # Color by region for consistent coloring
-    region_colors = px.colors.qualitative.Set3
+    # Shared sample; each region is capped so the dashboard shows ~6000 points
+    df_sample, xs, ys, zs = state.df_sample, state.xs, state.ys, state.zs
     
     # Add 2D plot - color by region
-    for i, region in enumerate(regions):
-        region_df = df_sample[df_sample['region'] == region]
-        if len(region_df) == 0:
+    for region in regions:
+        rows = _region_rows(state, region, 6000)
+        if rows is None or rows.start == rows.stop:
             continue
         
         fig.add_trace(
             go.Scattergl(
-                x=region_df['x_coordinate'],
-                y=region_df['y_coordinate'],
+                x=xs[rows],
+                y=ys[rows],
                 mode='markers',
                 marker=dict(
                     size=3,
-                    color=region_colors[i % len(region_colors)],
+                    color=state.region_colors[region],
                     opacity=0.7,
                     line=dict(width=0)
                 ),
-                text=[f"Gene: {g}<br>Region: {r}" 
-                      for g, r in zip(region_df['gene'], region_df['region'])],
+                text=_hover_text(df_sample.iloc[rows], ['gene', 'region']),
                 hovertemplate='<b>%{text}</b><extra></extra>',
                 name=region,
                 showlegend=True
@@ -381,24 +543,23 @@ def create_dashboard(df_overview, df_full, stats, genes, regions, fovs):
     )
     
     # Add 3D plot
-    for i, region in enumerate(regions):
-        region_df = df_sample[df_sample['region'] == region]
-        if len(region_df) == 0:
+    for region in regions:
+        rows = _region_rows(state, region, 6000)
+        if rows is None or rows.start == rows.stop:
             continue
         
         fig.add_trace(
             go.Scatter3d(
-                x=region_df['x_coordinate'],
-                y=region_df['y_coordinate'],
-                z=region_df['z_coordinate'],
+                x=xs[rows],
+                y=ys[rows],
+                z=zs[rows],
                 mode='markers',
                 marker=dict(
                     size=1.5,
-                    color=region_colors[i % len(region_colors)],
+                    color=state.region_colors[region],
                     opacity=0.6
                 ),
-                text=[f"Gene: {g}<br>Region: {r}" 
-                      for g, r in zip(region_df['gene'], region_df['region'])],
+                text=_hover_text(df_sample.iloc[rows], ['gene', 'region']),
                 hovertemplate='<b>%{text}</b><extra></extra>',
                 name=region,
                 showlegend=True
@@ -416,7 +577,7 @@ def create_dashboard(df_overview, df_full, stats, genes, regions, fovs):
         go.Bar(
             x=regions,
             y=cell_counts,
-            marker_color=region_colors[:len(regions)],
+            marker_color=[state.region_colors[region] for region in regions],
             showlegend=False
         ),
         row=2, col=2
@@ -464,6 +625,15 @@ def create_dashboard(df_overview, df_full, stats, genes, regions, fovs):
     return fig
 
 
+def _build_stamp(csv_path):
+    """Identify a build by the input CSV's and this script's size and mtime."""
+    parts = []
+    for path in [Path(csv_path), Path(__file__)]:
+        st = path.stat()
+        parts.append(f"{path}:{st.st_size}:{int(st.st_mtime)}")
+    return "\n".join(parts)
+
+
 def main():
     """Main function to generate all visualizations."""
     # Paths
@@ -471,9 +641,19 @@ def main():
     output_dir = Path(".")
     data_dir = Path("data")
     data_dir.mkdir(exist_ok=True)
+    outputs = [Path("index.html"), Path("view_3d.html"), Path("dashboard.html"),
+               data_dir / "overview.json", data_dir / "stats.json"]
+    
+    # Skip the rebuild when the input CSV and this script are unchanged
+    stamp_path = Path(csv_path).with_suffix('.stamp')
+    stamp = _build_stamp(csv_path)
+    if (stamp_path.exists() and stamp_path.read_text() == stamp
+            and all(output.exists() for output in outputs)):
+        print(f"Cache hit: {csv_path} unchanged since last build, skipping")
+        return
     
     # Load and process data
-    df, df_overview, genes, regions, fovs = load_and_process_data(csv_path)
+    df, df_overview, df_plot, genes, regions, fovs = load_and_process_data(csv_path)
     
     # Save overview data
     save_overview_data(df_overview, data_dir)
@@ -483,20 +663,21 @@ def main():
     
     # Create visualizations
     print("\nGenerating HTML files...")
+    state = _prepare_plot_state(df_plot, regions)
     
     # 2D View
-    fig_2d = create_2d_visualization(df_overview, df, genes, regions, fovs)
-    fig_2d.write_html("index.html", include_plotlyjs='cdn')
+    fig_2d = create_2d_visualization(state, df, genes, regions, fovs)
+    fig_2d.write_html("index.html", **WRITE_HTML_OPTIONS)
     print("✓ Created index.html")
     
     # 3D View
-    fig_3d = create_3d_visualization(df_overview, df, genes, regions, fovs)
-    fig_3d.write_html("view_3d.html", include_plotlyjs='cdn')
+    fig_3d = create_3d_visualization(state, df, genes, regions, fovs)
+    fig_3d.write_html("view_3d.html", **WRITE_HTML_OPTIONS)
     print("✓ Created view_3d.html")
     
     # Dashboard
-    fig_dash = create_dashboard(df_overview, df, stats, genes, regions, fovs)
-    fig_dash.write_html("dashboard.html", include_plotlyjs='cdn')
+    fig_dash = create_dashboard(state, df, stats, genes, regions, fovs)
+    fig_dash.write_html("dashboard.html", **WRITE_HTML_OPTIONS)
     print("✓ Created dashboard.html")
     
     print("\n✓ All visualizations generated successfully!")
@@ -507,6 +688,8 @@ def main():
     print(f"  - Regions: {len(regions)}")
     print(f"  - FOVs: {len(fovs)}")
     print(f"\nRegions: {', '.join(regions)}")
+    
+    stamp_path.write_text(stamp)
 
 
 if __name__ == "__main__":